@@ -1,3 +1,46 @@
+from operator import itemgetter
+
+
+def _write_json(path, obj):
+    import orjson
+
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+
+
+def ranking_metrics(labels, preds):
+    """
+    PR-AUC (average precision) and ROC-AUC from a single descending sort.
+    Tied scores are collapsed into one threshold, matching sklearn's
+    average_precision_score / roc_auc_score.
+    """
+    import numpy as np
+
+    order = np.argsort(preds, kind="stable")[::-1]
+    p = preds[order]
+    y = labels[order]
+
+    # last index of each distinct threshold
+    idx = np.r_[np.flatnonzero(np.diff(p)), y.size - 1]
+
+    tp = np.cumsum(y, dtype=np.float64)[idx]
+    fp = (idx + 1) - tp
+    P = tp[-1]
+    N = fp[-1]
+
+    # --- PR-AUC (step-wise, as in average_precision_score) ---
+    precision = tp / (tp + fp)
+    recall = tp / P
+    prauc = np.sum(np.diff(np.r_[0.0, recall]) * precision)
+
+    # --- ROC-AUC (trapezoid) ---
+    tpr = np.r_[0.0, recall]
+    fpr = np.r_[0.0, fp / N]
+    rocauc = np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1])) / 2
+
+    return float(prauc), float(rocauc)
+
+
 def evaluate(bst, dtest, params, top_n=25, run_dir=None):
     """
     Evaluates the model, prints key metrics, and optionally saves:
@@ -8,9 +51,7 @@ def evaluate(bst, dtest, params, top_n=25, run_dir=None):
       - params.json
     """
 
-    from sklearn.metrics import average_precision_score, roc_auc_score
     import numpy as np
-    import json
 
     if run_dir is not None:
         run_dir.mkdir(parents=True, exist_ok=True)
@@ -20,8 +61,7 @@ def evaluate(bst, dtest, params, top_n=25, run_dir=None):
     labels = dtest.get_label()
 
     # --- Metrics ---
-    prauc = float(average_precision_score(labels, preds))
-    rocauc = float(roc_auc_score(labels, preds))
+    prauc, rocauc = ranking_metrics(labels, preds)
     event_rate = float(labels.mean())
     lift = float(prauc / event_rate)
 
@@ -42,18 +82,15 @@ def evaluate(bst, dtest, params, top_n=25, run_dir=None):
             "rocauc": rocauc,
             "lift": lift,
         }
-        json.dump(metrics, open(run_dir / "metrics.json", "w"), indent=2)
-        json.dump(params, open(run_dir / "params.json", "w"), indent=2)
+        _write_json(run_dir / "metrics.json", metrics)
+        _write_json(run_dir / "params.json", params)
 
-        np.save(run_dir / "preds.npy", preds)
-        np.save(run_dir / "labels.npy", labels)
+        np.save(run_dir / "preds.npy", preds.astype(np.float32, copy=False))
+        np.save(run_dir / "labels.npy", labels.astype(np.float32, copy=False))
 
     # --- Feature Importances ---
-    importance = sorted(
-        bst.get_score(importance_type="gain").items(),
-        key=lambda x: x[1],
-        reverse=True
-    )
+    gain = bst.get_score(importance_type="gain")
+    importance = sorted(gain.items(), key=itemgetter(1), reverse=True)
 
     print("\n=============================")
     print(f" TOP {top_n} FEATURE IMPORTANCES (gain)")
@@ -63,10 +100,9 @@ def evaluate(bst, dtest, params, top_n=25, run_dir=None):
         print(f"{feat:40s} gain={score:.6f}")
 
     if run_dir:
-        json.dump(
+        _write_json(
+            run_dir / "feature_importance_gain.json",
             [{"feature": f, "gain": float(s)} for f, s in importance],
-            open(run_dir / "feature_importance_gain.json", "w"),
-            indent=2
         )
 
     return {
@@ -1,69 +1,35 @@
-def build_experiments(base_params):
-    EXPERIMENTS = []
+import os
+import threading
+from types import MappingProxyType
+
+
+# ---- One-at-a-time sweeps over BASE: (param, name prefix, values) ----
+SWEEPS = (
+    ("scale_pos_weight", "spw", (1, 2, 5, 10, 20, 50, 100)),
+    ("max_depth", "depth", (3, 4, 6, 8, 10, 12)),
+    ("eta", "eta", (0.3, 0.1, 0.05, 0.02, 0.01)),
+    ("subsample", "subsample", (0.5, 0.7, 0.9, 1.0)),
+    ("colsample_bytree", "colsample", (0.5, 0.7, 0.9, 1.0)),
+    ("max_bin", "maxbin", (64, 128, 256)),
+    ("min_child_weight", "mcw", (1, 5, 10, 20)),
+)
+
+
+def build_experiments(base_params, sweeps=SWEEPS):
+    """
+    Yields one params dict per experiment: the baseline, then each value of
+    each sweep applied on top of base_params. Wrap in list(...) if you need
+    to iterate more than once.
+    """
+    base = MappingProxyType(dict(base_params))
 
     # ---- Baseline ----
-    EXPERIMENTS.append({
-        **base_params,
-        "name": "baseline"
-    })
-
-    # ---- Sweep scale_pos_weight ----
-    for spw in [1, 2, 5, 10, 20, 50, 100]:
-        EXPERIMENTS.append({
-            **base_params,
-            "scale_pos_weight": spw,
-            "name": f"spw_{spw}"
-        })
-
-    # ---- Sweep max_depth ----
-    for depth in [3, 4, 6, 8, 10, 12]:
-        EXPERIMENTS.append({
-            **base_params,
-            "max_depth": depth,
-            "name": f"depth_{depth}"
-        })
-
-    # ---- Sweep learning rate eta ----
-    for eta in [0.3, 0.1, 0.05, 0.02, 0.01]:
-        EXPERIMENTS.append({
-            **base_params,
-            "eta": eta,
-            "name": f"eta_{eta}"
-        })
-
-    # ---- Sweep subsample ----
-    for ss in [0.5, 0.7, 0.9, 1.0]:
-        EXPERIMENTS.append({
-            **base_params,
-            "subsample": ss,
-            "name": f"subsample_{ss}"
-        })
-
-    # ---- Sweep colsample_bytree ----
-    for cs in [0.5, 0.7, 0.9, 1.0]:
-        EXPERIMENTS.append({
-            **base_params,
-            "colsample_bytree": cs,
-            "name": f"colsample_{cs}"
-        })
-
-    # ---- Sweep max_bin ----
-    for mb in [64, 128, 256]:
-        EXPERIMENTS.append({
-            **base_params,
-            "max_bin": mb,
-            "name": f"maxbin_{mb}"
-        })
-
-    # ---- Sweep min_child_weight ----
-    for mcw in [1, 5, 10, 20]:
-        EXPERIMENTS.append({
-            **base_params,
-            "min_child_weight": mcw,
-            "name": f"mcw_{mcw}"
-        })
-
-    return EXPERIMENTS
+    yield {**base, "name": "baseline"}
+
+    # ---- Sweeps ----
+    for key, prefix, values in sweeps:
+        for v in values:
+            yield {**base, key: v, "name": f"{prefix}_{v}"}
 
 
 BASE = {
@@ -79,4 +45,90 @@ BASE = {
     "scale_pos_weight": 1,
 }
 
-EXPERIMENTS = build_experiments(BASE)
\ No newline at end of file
+EXPERIMENTS = list(build_experiments(BASE))
+
+
+# ---- Parallel sweep driver ----
+
+def physical_cores():
+    try:
+        import psutil
+        n = psutil.cpu_count(logical=False)
+    except ImportError:
+        n = None
+    return n or os.cpu_count() or 1
+
+
+# evaluate() prints a multi-line report, so concurrent fits take turns
+# evaluating instead of interleaving their output.
+_EVAL_LOCK = threading.Lock()
+
+
+def run_one(params, datasets, nthread, run_root=None):
+    """
+    Trains and evaluates a single experiment with XGBoost pinned to nthread.
+    """
+    import xgboost as xgb
+    from evaluate import evaluate
+
+    dtrain, dval, dtest = datasets
+    params = dict(params)
+    name = params.pop("name")
+    params["nthread"] = nthread
+
+    bst = xgb.train(
+        params=params,
+        dtrain=dtrain,
+        evals=[(dval, "val")],
+        num_boost_round=2000,
+        early_stopping_rounds=50,
+        verbose_eval=False,
+    )
+
+    run_dir = run_root / name if run_root is not None else None
+    with _EVAL_LOCK:
+        return name, evaluate(bst, dtest, params, run_dir=run_dir)
+
+
+def run_sweep(make_datasets, experiments=EXPERIMENTS, threads_per_fit=2, run_root=None):
+    """
+    Runs experiments concurrently, physical_cores() // threads_per_fit fits at a
+    time, each fit limited to threads_per_fit XGBoost threads. Past ~12
+    threads a single fit stops scaling, so many narrow fits beat one wide one.
+
+    make_datasets(max_bin) returns (dtrain, dval, dtest), e.g.
+    lambda max_bin: build_datasets(max_bin, external_memory=False) from
+    xgboost.py. A QuantileDMatrix is binned once, and training it with another
+    max_bin fails, so experiments are grouped by max_bin and each group gets
+    its own matrices, built when the group starts and released after it.
+
+    Uses the threading backend: xgb.train releases the GIL, and the matrices
+    are shared in-process by every fit in the group instead of being pickled
+    to each worker. They must be in-memory QuantileDMatrix/DMatrix: an
+    ExtMemQuantileDMatrix streams its pages through one shared cursor, which
+    concurrent boosters cannot share, so it is rejected.
+    """
+    import xgboost as xgb
+    from joblib import Parallel, delayed
+
+    n_jobs = max(1, physical_cores() // threads_per_fit)
+
+    groups = {}
+    for p in experiments:
+        groups.setdefault(p["max_bin"], []).append(p)
+
+    results = {}
+    for max_bin, group in groups.items():
+        datasets = make_datasets(max_bin)
+        if any(isinstance(d, xgb.ExtMemQuantileDMatrix) for d in datasets):
+            raise TypeError(
+                "run_sweep shares each matrix across concurrent fits; "
+                "make_datasets must return in-memory matrices, not ExtMemQuantileDMatrix"
+            )
+        results.update(Parallel(n_jobs=n_jobs, backend="threading")(
+            delayed(run_one)(p, datasets, threads_per_fit, run_root)
+            for p in group
+        ))
+        del datasets
+
+    return {p["name"]: results[p["name"]] for p in experiments}
@@ -1,21 +1,55 @@
+from functools import lru_cache
+
+import numpy as np
 from h3 import h3
 
+
+@lru_cache(maxsize=None)
+def _disk(cell, k):
+    return frozenset(h3.k_ring(cell, k))
+
+
 def expand_to_neighbors(cell_list, k=1):
     """
     Expand base H3 cells to include k-ring neighbors.
+    Each distinct cell's ring is computed once (memoized across calls)
+    and all rings are merged in a single union.
     Returns a set.
     """
-    expanded = set()
-    for cell in cell_list:
-        expanded.update(h3.k_ring(cell, k))
-    return expanded
+    unique_cells = dict.fromkeys(cell_list)
+    return set().union(*(_disk(cell, k) for cell in unique_cells))
+
+
+def cells_to_ints(cells):
+    """
+    H3 hex strings -> uint64 array (an H3 string is its index in hex).
+    """
+    return np.fromiter((int(c, 16) for c in cells), dtype=np.uint64)
+
+
+def build_universe(all_cells):
+    """
+    Sorted, de-duplicated uint64 array of the valid cells.
+    Build once and reuse for every restrict_to_valid call.
+    """
+    return np.unique(cells_to_ints(all_cells))
 
 
 def restrict_to_valid(expanded_cells, valid_universe):
     """
-    Intersect expanded cells with a larger universe
+    Intersect expanded cells with a larger universe (from build_universe).
+    The lookup runs on uint64s; the surviving cells are returned as a set
+    of the original hex strings, ready for h3.* calls.
     """
-    return expanded_cells.intersection(valid_universe)
+    cells = list(expanded_cells)
+    if valid_universe.size == 0:
+        return set()
+
+    e = cells_to_ints(cells)
+    idx = np.searchsorted(valid_universe, e)
+    idx[idx == valid_universe.size] = 0
+    keep = valid_universe[idx] == e
+    return {cell for cell, k in zip(cells, keep.tolist()) if k}
 
 
 # ---------------------------
@@ -28,7 +62,7 @@ base_cells = [
 ]
 
 # This is your global universe
-all_cells = set([
+all_cells = build_universe([
     "831c6ffffffffff",
     "831c2fffffffffff",
     "831c0fffffffffff",
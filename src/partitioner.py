@@ -1,35 +1,94 @@
-use std::collections::HashMap;
+use ahash::AHashMap;
 
 #[derive(Debug, Clone)]
 struct FlatRecord {
     year: Option<u16>,
     month: Option<u8>,
     day: Option<u8>,
-    h3_cell: Option<String>,
+    // H3 index as its 64-bit integer, parsed once with `parse_h3` when the row is built
+    h3_cell: Option<u64>,
     // ... all your other 80+ fields ...
 }
 
+/// (year, month, day, h3_cell). A missing h3_cell maps to 0, which is never a valid H3 index.
+type PartitionKey = (u16, u8, u8, u64);
+
+/// "831c6ffffffffff" -> 0x831c6ffffffffff. The H3 string form is the index in hex.
+fn parse_h3(cell: &str) -> Option<u64> {
+    u64::from_str_radix(cell, 16).ok()
+}
+
+/// Column buffers for one partition (struct-of-arrays).
+/// Each field of FlatRecord gets its own Vec, so column scans are sequential
+/// and each Vec maps straight onto one Arrow array / Parquet column chunk.
+#[derive(Debug, Default)]
+struct FlatPartition {
+    year: Vec<u16>,
+    month: Vec<u8>,
+    day: Vec<u8>,
+    h3_cell: Vec<u64>,
+    // ... one Vec per remaining field, e.g. `name: Vec<Option<String>>` ...
+}
+
+impl FlatPartition {
+    fn with_capacity(n: usize) -> Self {
+        Self {
+            year: Vec::with_capacity(n),
+            month: Vec::with_capacity(n),
+            day: Vec::with_capacity(n),
+            h3_cell: Vec::with_capacity(n),
+        }
+    }
+
+    fn len(&self) -> usize {
+        self.year.len()
+    }
+
+    /// Decompose one row into the column buffers (moves any owned fields).
+    fn push_record(&mut self, rec: FlatRecord) {
+        self.year.push(rec.year.unwrap_or_default());
+        self.month.push(rec.month.unwrap_or_default());
+        self.day.push(rec.day.unwrap_or_default());
+        self.h3_cell.push(rec.h3_cell.unwrap_or_default());
+    }
+}
+
+#[inline]
+fn partition_key(rec: &FlatRecord) -> PartitionKey {
+    (
+        rec.year.unwrap_or_default(),
+        rec.month.unwrap_or_default(),
+        rec.day.unwrap_or_default(),
+        rec.h3_cell.unwrap_or_default(),
+    )
+}
+
 /// Partitions a vector of FlatRecord structs into a HashMap.
 /// Each unique (year, month, day, h3_cell) combination becomes one key,
-/// and its corresponding Vec<FlatRecord> contains all rows belonging to that partition.
-fn partition_records(
-    records: Vec<FlatRecord>,
-) -> HashMap<(u16, u8, u8, String), Vec<FlatRecord>> {
-    let mut partitions: HashMap<(u16, u8, u8, String), Vec<FlatRecord>> = HashMap::new();
+/// and its corresponding FlatPartition holds the columns of all rows belonging to that partition.
+///
+/// The key is four integers, so building it allocates nothing and hashes fast (aHash).
+/// A first pass counts the rows of each key, so every partition's columns are
+/// allocated once at their final size.
+fn partition_records(records: Vec<FlatRecord>) -> AHashMap<PartitionKey, FlatPartition> {
+    let mut counts: AHashMap<PartitionKey, usize> =
+        AHashMap::with_capacity(records.len() / 64); // heuristic pre-allocation
+    for rec in &records {
+        *counts.entry(partition_key(rec)).or_default() += 1;
+    }
+
+    let mut partitions: AHashMap<PartitionKey, FlatPartition> = counts
+        .into_iter()
+        .map(|(key, n)| (key, FlatPartition::with_capacity(n)))
+        .collect();
 
     for rec in records {
-        // Build a unique key tuple for this record.
-        // We use `unwrap_or_default()` to avoid None values crashing the grouping logic.
-        let key = (
-            rec.year.unwrap_or_default(),
-            rec.month.unwrap_or_default(),
-            rec.day.unwrap_or_default(),
-            rec.h3_cell.clone().unwrap_or_else(|| "unknown".to_string()),
-        );
-
-        // Push the record into its partition (automatically creates Vec if missing)
-        partitions.entry(key).or_default().push(rec);
+        // Records are moved into their partition's columns, never cloned.
+        partitions
+            .get_mut(&partition_key(&rec))
+            .expect("every key was counted above")
+            .push_record(rec);
     }
 
     partitions
-}
\ No newline at end of file
+}
@@ -1,4 +1,5 @@
-use std::collections::HashMap;
+use std::collections::{HashMap, HashSet};
+use std::sync::Arc;
 
 #[derive(Debug, Clone)]
 struct FlatRecord {
@@ -47,6 +48,28 @@ struct FlatRecord {
     business_outlook: Option<String>,
 }
 
+/// (category, tag, country_code, h3_cell), each an interned string.
+type PartitionKey = (Arc<str>, Arc<str>, Arc<str>, Arc<str>);
+
+/// Hands out one shared `Arc<str>` per distinct string.
+/// A repeated value costs a hash lookup and a refcount bump instead of a
+/// fresh heap allocation, and every key holding it shares one buffer.
+#[derive(Default)]
+struct Interner {
+    strings: HashSet<Arc<str>>,
+}
+
+impl Interner {
+    fn intern(&mut self, s: &str) -> Arc<str> {
+        if let Some(shared) = self.strings.get(s) {
+            return Arc::clone(shared);
+        }
+        let shared: Arc<str> = Arc::from(s);
+        self.strings.insert(Arc::clone(&shared));
+        shared
+    }
+}
+
 /// ─────────────────────────────────────────────────────────────
 ///  Partition Vec<FlatRecord> by (category, tag, country_code, h3_cell)
 /// ─────────────────────────────────────────────────────────────
@@ -58,20 +81,27 @@ struct FlatRecord {
 ///
 /// This is exactly how you’d pre-bucket data before converting to Arrow
 /// and writing to Parquet.
-fn partition_records(
-    records: Vec<FlatRecord>,
-) -> HashMap<(String, String, String, String), Vec<FlatRecord>> {
-    let mut partitions: HashMap<(String, String, String, String), Vec<FlatRecord>> =
+fn partition_records(records: Vec<FlatRecord>) -> HashMap<PartitionKey, Vec<FlatRecord>> {
+    let mut partitions: HashMap<PartitionKey, Vec<FlatRecord>> =
         HashMap::with_capacity(records.len() / 8); // heuristic pre-allocation
 
+    // Few distinct values against many rows: intern them, and share a single
+    // "unknown" instead of allocating one per missing field.
+    let mut interner = Interner::default();
+    let unknown: Arc<str> = Arc::from("unknown");
+
     for rec in records {
         // Build a unique key tuple for this record.
         // Use "unknown" when Option is None so you don’t collapse valid partitions.
+        let mut part = |field: &Option<String>| match field.as_deref() {
+            Some(s) => interner.intern(s),
+            None => Arc::clone(&unknown),
+        };
         let key = (
-            rec.category.clone().unwrap_or_else(|| "unknown".to_string()),
-            rec.tag.clone().unwrap_or_else(|| "unknown".to_string()),
-            rec.country_code.clone().unwrap_or_else(|| "unknown".to_string()),
-            rec.h3_cell.clone().unwrap_or_else(|| "unknown".to_string()),
+            part(&rec.category),
+            part(&rec.tag),
+            part(&rec.country_code),
+            part(&rec.h3_cell),
         );
 
         // Push the record into its partition (creates Vec if missing)
@@ -79,4 +109,4 @@ fn partition_records(
     }
 
     partitions
-}
\ No newline at end of file
+}
@@ -1,776 +1,864 @@
 import polars as pl
+import os
+import json
+from datetime import timedelta, datetime
+from functools import lru_cache
 
-###############################################################
-# CONFIGURATION
-###############################################################
 
-PARQUET_PATH = "s3://bucket/path/**/*.parquet"
+# The input columns every pipeline reads
+INPUT_COLUMNS = [
+    "obs_id",
+    "timestamp",
+    "h3_res3",
+    "location_weight",
+    "measurement_type",
+    "measurement_weight",
+]
 
-# Define rolling window sizes
-WINDOWS = {
-    "1h": 1,
-    "6h": 6,
-    "12h": 12,
-    "24h": 24,
-}
 
-# Output folder
-OUTPUT_PATH = "s3://bucket/features/"
+def scan_input(path, columns):
+    """
+    Lazy scan of the flattened input reading only `columns`, and the
+    expression that yields its timestamp as Datetime("us").
 
-###############################################################
-# GLOBAL LAZY SCAN
-###############################################################
-lf = pl.scan_parquet(PARQUET_PATH)
+    The frame stays a bare scan, so every filter applied to it is pushed into
+    the parquet reader (row-group skipping included).
+    """
+    # S3 reader tuning: region for the object store client (from AWS_REGION;
+    # unset lets the client resolve it from the usual AWS config), and how
+    # many concurrent range requests the cloud reader may keep in flight.
+    storage_options = (
+        {"aws_region": os.environ["AWS_REGION"]} if "AWS_REGION" in os.environ else None
+    )
+    os.environ.setdefault("POLARS_CONCURRENCY_BUDGET", "32")
 
-###############################################################
-# STEP 0: BUILD GLOBAL MEASUREMENT VOCABULARY
-###############################################################
-print("Extracting global measurement vocabulary…")
+    # Streaming engine: rows per morsel, small enough to stay cache-resident
+    pl.Config.set_streaming_chunk_size(50_000)
 
-global_vocab = (
-    lf.filter(pl.col("measurement_type").is_not_null())
-      .select("measurement_type")
-      .unique()
-      .collect()
-)
+    lf = (
+        pl.scan_parquet(
+            path,
+            storage_options=storage_options,
+            hive_partitioning=False,    # every column used is in the files
+        )
+          .select(columns)
+    )
 
-measurement_types = global_vocab["measurement_type"].to_list()
-print(f"Found {len(measurement_types)} measurement types.")
+    # Files that already store a timestamp type only need the unit pinned;
+    # anything else goes through the string parse (naive UTC). Returned as an
+    # expression rather than applied to lf: a with_columns holding the
+    # format-inferring parse stops predicate pushdown for every filter above it.
+    if isinstance(lf.collect_schema()["timestamp"], pl.Datetime):
+        timestamp = pl.col("timestamp").dt.cast_time_unit("us")
+    else:
+        timestamp = (
+            pl.col("timestamp")
+              .cast(pl.Utf8)
+              .str.to_datetime(time_unit="us", strict=False)
+        )
 
+    return lf, timestamp
 
-###############################################################
-# STEP 1: GET ALL UNIQUE H3 CELLS (res3)
-###############################################################
-print("Extracting all unique H3 cells…")
 
-unique_cells_df = (
-    lf.select(pl.col("h3_res3"))
-      .drop_nulls()
-      .unique()
-      .collect()
-)
+def run_dynamic_window_pipeline():
+    """
+    Lazy pipeline: atomic rows joined once, hourly pivot, group_by_dynamic
+    windows, one partitioned sink per cell.
+    """
+    ###############################################################
+    # CONFIGURATION
+    ###############################################################
 
-cells = unique_cells_df["h3_res3"].to_list()
-print(f"Found {len(cells)} unique cells.")
+    PARQUET_PATH = "s3://bucket/path/**/*.parquet"
 
+    # Define rolling window sizes
+    WINDOWS = {
+        "1h": 1,
+        "6h": 6,
+        "12h": 12,
+        "24h": 24,
+    }
 
-###############################################################
-# PROCESS EACH CELL
-###############################################################
+    # Output folder
+    OUTPUT_PATH = "s3://bucket/features/"
 
-for target_cell in cells:
+    # Cached global lookups (vocabulary, cell list), reused across runs
+    CACHE_PATH = f"{OUTPUT_PATH}_cache"
 
-    print(f"\n\n==============================")
-    print(f"Processing cell: {target_cell}")
-    print("==============================\n")
+    ###############################################################
+    # GLOBAL LAZY SCAN
+    #   Only the input columns are ever read from the files; timestamp
+    #   is parsed only where a step selects it
+    ###############################################################
+    lf, timestamp = scan_input(PARQUET_PATH, INPUT_COLUMNS)
 
-    # STEP 2: materialize obs_ids as a Series
-    obs_ids = (
-        lf.filter(pl.col("h3_res3") == target_cell)
-          .select("obs_id")
-          .unique()
-          .collect()
-          .get_column("obs_id")
-    )
+    ###############################################################
+    # CACHED GLOBAL LOOKUPS
+    #   STEP 0 and STEP 1 need a full scan of the input. Their
+    #   (tiny) results are kept as Arrow IPC under CACHE_PATH, next to a
+    #   manifest of the input files they were built from; any added,
+    #   removed or rewritten input file invalidates them.
+    ###############################################################
+    def input_manifest():
+        """
+        {path: "etag-or-mtime:size"} for every input Parquet file, or None
+        when fsspec isn't installed (caching is then skipped).
+        """
+        try:
+            import fsspec
+        except ImportError:
+            return None
+
+        fs, pattern = fsspec.core.url_to_fs(PARQUET_PATH)
+        return {
+            path: f"{info.get('ETag') or info.get('mtime')}:{info.get('size')}"
+            for path, info in sorted(fs.glob(pattern, detail=True).items())
+        }
+
+    def load_or_build(name, build_fn, manifest):
+        """
+        Returns {CACHE_PATH}/{name}.arrow if it was built from the same input
+        files, otherwise build_fn() -- which is then written to the cache.
+        """
+        if manifest is None:
+            return build_fn()
+
+        import fsspec
+
+        fs, cache_dir = fsspec.core.url_to_fs(CACHE_PATH)
+        table_path = f"{cache_dir}/{name}.arrow"
+        manifest_path = f"{cache_dir}/{name}.manifest.json"
+
+        try:
+            with fs.open(manifest_path, "r") as f:
+                if json.load(f) == manifest:
+                    with fs.open(table_path, "rb") as f:
+                        return pl.read_ipc(f)
+        except FileNotFoundError:
+            pass
+
+        df = build_fn()
+        fs.makedirs(cache_dir, exist_ok=True)
+        with fs.open(table_path, "wb") as f:
+            df.write_ipc(f)
+        # Manifest last: a half-written cache is never taken as valid
+        with fs.open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        return df
+
+    manifest = input_manifest()
+
+    @lru_cache(maxsize=None)
+    def scan_vocab_and_cells():
+        """
+        Vocabulary and cell list from a single pass over the input: one select
+        reads both columns and reduces each to its unique values. Runs only on
+        a cache miss, and at most once even if both lookups miss.
+        """
+        row = (
+            lf.select(
+                pl.col("measurement_type").drop_nulls().unique().implode(),
+                pl.col("h3_res3").drop_nulls().unique().implode(),
+            )
+            .collect(engine="streaming")
+        )
+        return (
+            row.select(pl.col("measurement_type").explode()),
+            row.select(pl.col("h3_res3").explode()),
+        )
 
-    if obs_ids.len() == 0:
-        print(f"Cell {target_cell} has no obs_ids — skipping.")
-        continue
+    ###############################################################
+    # STEP 0: BUILD GLOBAL MEASUREMENT VOCABULARY
+    ###############################################################
+    print("Extracting global measurement vocabulary…")
 
-    # STEP 3: load all rows for these obs_ids
-    df = (
-        lf.filter(pl.col("obs_id").is_in(obs_ids))
-          .collect()
-    )
+    global_vocab = load_or_build("global_vocab", lambda: scan_vocab_and_cells()[0], manifest)
 
-    # robust timestamp conversion
-    df = df.with_columns(
-        pl.col("timestamp")
-          .cast(pl.Utf8)
-          .str.to_datetime(strict=False)    # naive UTC
-    ).sort("timestamp")
+    measurement_types = global_vocab["measurement_type"].to_list()
+    print(f"Found {len(measurement_types)} measurement types.")
 
-    if df.is_empty():
-        print(f"Cell {target_cell} has no data — skipping after ts parse.")
-        continue
+    # Fixed global category set: measurement_type is carried as u32 codes, and
+    # every pivot below sees the same categories in the same order.
+    meas_enum = pl.Enum(measurement_types)
 
     ###############################################################
-    # STEP 4: Build loc_df (candidate locations)
+    # STEP 1: GET ALL UNIQUE H3 CELLS (res3)
+    ###############################################################
+    print("Extracting all unique H3 cells…")
+
+    unique_cells_df = load_or_build("unique_cells", lambda: scan_vocab_and_cells()[1], manifest)
+
+    cells = unique_cells_df["h3_res3"].to_list()
+    print(f"Found {len(cells)} unique cells.")
+
+    # Same for h3_res3: every group_by / over / partition below keys on u32 codes
+    cell_enum = pl.Enum(cells)
+
+    ###############################################################
+    # PROCESS ALL CELLS IN ONE QUERY
+    #   No per-cell loop: STEPs 2-12 build a single LazyFrame keyed by
+    #   h3_res3, so the dataset is scanned once for every cell and the
+    #   sink in STEP 13 writes one file per cell.
+    ###############################################################
+
+    ###############################################################
+    # STEP 2-3: Rows of interest, without an obs_id round-trip
+    #   The cell filter sits on the location rows (STEP 4), where it is
+    #   pushed into the parquet scan and can skip row groups by h3_res3
+    #   statistics. Measurement rows need no filter: the left join in
+    #   STEP 6-7 keeps only obs_ids with a location in `cells`
+    #   (trim `cells` to run a subset).
+    ###############################################################
+    df = lf.with_columns(pl.col("measurement_type").cast(meas_enum))
+
+    ###############################################################
+    # STEP 4: Build loc_df (candidate locations, one row each)
+    #   Kept flat: it is joined on obs_id, so grouping it into per-cell
+    #   lists only to explode them again bought nothing
     ###############################################################
     loc_df = (
-        df.filter(pl.col("location_weight").is_not_null())
-          .select(["h3_res3", "obs_id", "location_weight"])
-          .unique()
-          .group_by("h3_res3")
-          .agg([
-              pl.col("obs_id").list().alias("obs_ids"),
-              pl.col("location_weight").list().alias("location_weights"),
+        df.filter(
+            pl.col("location_weight").is_not_null()
+            & pl.col("h3_res3").is_in(cells)
+        )
+          # cast after the filter, so the scan still prunes on the raw strings
+          .select([
+              pl.col("h3_res3").cast(cell_enum),
+              "obs_id",
+              "location_weight",
+              timestamp,
           ])
+          .unique()
     )
 
     ###############################################################
-    # STEP 5: Build meas_df (candidate measurement types)
+    # STEP 5: Build meas_df (candidate measurement types, one row each)
+    #   A candidate is keyed by (obs_id, measurement_type); repeats from
+    #   the flattening carry the same weight, so dedup on the narrow key
+    #   instead of hashing the weight as well
     ###############################################################
     meas_df = (
         df.filter(pl.col("measurement_weight").is_not_null())
-          .select(["obs_id", "measurement_type", "measurement_weight"])
-          .unique()
-          .group_by("obs_id")
-          .agg([
-              pl.col("measurement_type").list().alias("measurement_types"),
-              pl.col("measurement_weight").list().alias("measurement_weights"),
-          ])
+          .group_by(["obs_id", "measurement_type"])
+          .agg(pl.col("measurement_weight").first())
     )
 
     ###############################################################
-    # STEP 6: Explode location ambiguity
+    # STEP 6-9: Join straight to atomic rows
+    #   One row per (location candidate × measurement candidate) of an
+    #   obs_id, carrying its PMHT-style weighted contribution
+    #   signal_weight = location_weight × measurement_weight.
+    #   Both sides stay flat, so there are no per-obs lists to build and
+    #   explode again.
+    #   Float32: weights are products of probabilities in [0, 1], and the
+    #   window sums downstream are bandwidth-bound, so half the bytes is
+    #   ~twice the throughput (and half the parquet size)
     ###############################################################
-    loc_expanded = (
-        loc_df
-          .explode(["obs_ids", "location_weights"])
-          .rename({
-              "obs_ids": "obs_id",
-              "location_weights": "location_weight"
-          })
+    final = (
+        loc_df.join(meas_df, on="obs_id", how="left")
+              .select([
+                  "h3_res3",
+                  "timestamp",
+                  "measurement_type",
+                  (pl.col("location_weight").cast(pl.Float32)
+                   * pl.col("measurement_weight").cast(pl.Float32))
+                      .alias("signal_weight"),
+              ])
     )
 
     ###############################################################
-    # STEP 7: Join with measurement ambiguity
+    # STEP 10: Bucket to the hour, then pivot into wide format
+    #   (one row per cell × hour)
+    #   Summing per (cell, hour, type) first shrinks the pivot input to at
+    #   most one row per output cell, and every row lands on the hourly grid
+    #   used below. on_columns fixes the output schema up front, which is
+    #   what lets the pivot stay lazy.
     ###############################################################
-    joined = loc_expanded.join(meas_df, on="obs_id", how="left")
+    hourly = (
+        final.with_columns(pl.col("timestamp").dt.truncate("1h"))
+             .group_by(["h3_res3", "timestamp", "measurement_type"])
+             .agg(pl.col("signal_weight").sum())
+    )
+
+    pivoted = hourly.pivot(
+        on="measurement_type",
+        on_columns=measurement_types,
+        index=["h3_res3", "timestamp"],
+        values="signal_weight",
+        aggregate_function="sum",
+    )
 
     ###############################################################
-    # STEP 8: Explode measurement lists → atomic rows
+    # STEP 10B: Order each cell's hours for the time-based windows
+    #   No dense hourly grid: STEP 12 windows over the observed hours
+    #   only, so the table never grows to one row per empty hour.
+    #   Cached: all four window passes in STEP 12 read this one frame, so
+    #   the scan → join → pivot beneath it runs once, not per window.
     ###############################################################
-    joined_expanded = joined.explode(["measurement_types", "measurement_weights"])
+    pivoted = pivoted.sort(["h3_res3", "timestamp"]).cache()
 
     ###############################################################
-    # STEP 9: Compute PMHT-style weighted contribution
+    # STEP 11: Ensure full measurement vocabulary exists
+    #   Nothing to do: on_columns=measurement_types in STEP 10 emits
+    #   every type, and STEP 12 treats types absent from a cell as zero.
     ###############################################################
-    final = joined_expanded.with_columns([
-        (pl.col("location_weight") * pl.col("measurement_weights"))
-            .alias("signal_weight")
-    ])
 
     ###############################################################
-    # STEP 10: Pivot into wide format
+    # STEP 12: Rolling-window feature generation (time-based, per cell)
+    #   For every hour t, the window of `span` hours ending at t, i.e.
+    #   the hourly buckets t-(span-1) … t. group_by_dynamic only emits
+    #   windows that hold data, and only sums the rows that exist.
     ###############################################################
-    pivoted = final.pivot(
-        index="timestamp",
-        columns="measurement_type",
-        values="signal_weight",
-        aggregate_function="sum"
-    ).sort("timestamp")
+    def window_features(label, span):
+        return (
+            pivoted.group_by_dynamic(
+                "timestamp",
+                every="1h",
+                period=f"{span}h",
+                offset=f"-{span - 1}h",    # window [t-(span-1)h, t+1h)
+                closed="left",
+                label="right",
+                group_by="h3_res3",
+            )
+            .agg(
+                [pl.col(mt).sum().alias(f"{mt}__sum_{label}") for mt in measurement_types]
+                # presence count: Boolean sum; max count is the span, fits UInt8
+                + [(pl.col(mt) > 0).sum().cast(pl.UInt8).alias(f"{mt}__count_{label}")
+                   for mt in measurement_types]
+            )
+            # label="right" stamps the window's end (t+1h); label it with t
+            .with_columns(pl.col("timestamp") - pl.duration(hours=1))
+        )
+
+    # The widest window is non-empty wherever a narrower one is, so it is the
+    # base; hours where a narrower window holds no data get zeros.
+    by_span = sorted(WINDOWS.items(), key=lambda kv: kv[1], reverse=True)
+
+    rolling = window_features(*by_span[0])
+    for label, span in by_span[1:]:
+        rolling = rolling.join(
+            window_features(label, span), on=["h3_res3", "timestamp"], how="left"
+        )
+
+    rolling = (
+        rolling.fill_null(0)
+               .select(
+                   ["h3_res3", "timestamp"]
+                   + [f"{mt}__{kind}_{label}"
+                      for label in WINDOWS
+                      for kind in ("sum", "count")
+                      for mt in measurement_types]
+               )
+    )
 
     ###############################################################
-    # STEP 10B: Resample timestamps to exact 1-hour grid
+    # STEP 13: Save one feature table per cell
+    #   The only point where the plan executes; the partitioned sink
+    #   writes every cell to {OUTPUT_PATH}/h3=<cell>/features.parquet in
+    #   one pass instead of one filter-and-write per cell. It only sets
+    #   the file layout: the pivot, group_by_dynamic and window joins
+    #   above still build the whole rolling table in memory first
     ###############################################################
-    pivoted = (
-        pivoted
-            .set_sorted("timestamp")
-            .upsample(time_column="timestamp", every="1h")
-            .fill_null(0.0)
+    rolling.sink_parquet(
+        pl.PartitionBy(
+            OUTPUT_PATH,
+            key="h3_res3",
+            include_key=False,
+            approximate_bytes_per_file=None,   # exactly one file per cell
+            file_path_provider=lambda args: (
+                f"h3={args.partition_keys['h3_res3'][0]}/features.parquet"
+            ),
+        ),
+        compression="zstd",
+        row_group_size=100_000,
+        mkdir=True,
     )
 
+    print(f"✔ Finished {len(cells)} cells → {OUTPUT_PATH}")
+
+
+def run_global_pipeline():
+    """
+    Global-join pipeline: every cell on one hourly grid, windows from
+    cumulative sums over h3_res3.
+    """
     ###############################################################
-    # STEP 11: Ensure full measurement vocabulary exists
+    # CONFIGURATION
     ###############################################################
-    for mt in measurement_types:
-        if mt not in pivoted.columns:
-            pivoted = pivoted.with_columns(pl.lit(0.0).alias(mt))
+
+    PARQUET_PATH = "s3://bucket/path/**/*.parquet"
+    WINDOWS = {"1h": 1, "6h": 6, "12h": 12, "24h": 24}
+    OUTPUT_PATH = "s3://bucket/features/"
 
     ###############################################################
-    # STEP 12: Rolling-window feature generation
+    # GLOBAL LAZY SCAN
+    #   Only the input columns are ever read from the files; timestamp
+    #   is parsed only where a step selects it
     ###############################################################
-    rolling = pivoted
+    lf, timestamp = scan_input(PARQUET_PATH, INPUT_COLUMNS)
 
-    for label, span in WINDOWS.items():
-        # Sum over window
-        rolling = rolling.with_columns([
-            pl.col(mt)
-              .rolling_sum(span)
-              .alias(f"{mt}__sum_{label}")
-            for mt in measurement_types
-        ])
-    
-        # Count of presence over window (nonzero)
-        rolling = rolling.with_columns([
-            (pl.col(mt) > 0)
-              .cast(pl.Int32)
-              .rolling_sum(span)
-              .alias(f"{mt}__count_{label}")
-            for mt in measurement_types
-        ])
+    ###############################################################
+    # STEP 0: GLOBAL MEASUREMENT VOCABULARY
+    ###############################################################
+    global_vocab = (
+        lf.filter(pl.col("measurement_type").is_not_null())
+          .select("measurement_type")
+          .unique()
+          .collect(engine="streaming")
+    )
+    measurement_types = global_vocab["measurement_type"].to_list()
 
-    # Remove original measurement-weight columns
-    rolling = rolling.drop_columns(measurement_types)
-    
-    ###############################################################
-    # STEP 13: Save feature table for this cell
-    ###############################################################
-    output_file = f"{OUTPUT_PATH}/h3={target_cell}/features.parquet"
-    rolling.write_parquet(output_file)
-
-    print(f"✔ Finished cell {target_cell} → {output_file}")
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-import polars as pl
-
-###############################################################
-# CONFIGURATION
-###############################################################
-
-PARQUET_PATH = "s3://bucket/path/**/*.parquet"
-WINDOWS = {"1h": 1, "6h": 6, "12h": 12, "24h": 24}
-OUTPUT_PATH = "s3://bucket/features/"
-
-
-###############################################################
-# GLOBAL LAZY SCAN
-###############################################################
-lf = pl.scan_parquet(PARQUET_PATH)
-
-###############################################################
-# STEP 0: GLOBAL MEASUREMENT VOCABULARY
-###############################################################
-global_vocab = (
-    lf.filter(pl.col("measurement_type").is_not_null())
-      .select("measurement_type")
-      .unique()
-      .collect()
-)
-measurement_types = global_vocab["measurement_type"].to_list()
-
-
-###############################################################
-# STEP 1: GLOBAL PMHT ATOMIC TABLE (NO CELL LOOP)
-###############################################################
-loc_lf = (
-    lf.filter(pl.col("location_weight").is_not_null())
-      .select(["obs_id", "timestamp", "h3_res3", "location_weight"])
-)
-
-meas_lf = (
-    lf.filter(pl.col("measurement_weight").is_not_null())
-      .select(["obs_id", "timestamp", "measurement_type", "measurement_weight"])
-)
-
-atomic_df = (
-    loc_lf.join(meas_lf, on=["obs_id", "timestamp"], how="inner")
-          .with_columns(
-              (pl.col("location_weight") * pl.col("measurement_weight"))
-                  .alias("signal_weight")
-          )
-          .with_columns(pl.col("timestamp").str.to_datetime())
-          .sort("timestamp")
-          .collect()
-)
+    # Join / group_by / pivot keys as integer codes rather than strings:
+    # measurement_type over its fixed global vocabulary, h3_res3 as Categorical
+    meas_enum = pl.Enum(measurement_types)
 
+    ###############################################################
+    # STEP 1: GLOBAL PMHT ATOMIC TABLE (NO CELL LOOP)
+    #   Everything from here on is one lazy plan: a single scan, with
+    #   only the projected columns read from Parquet.
+    ###############################################################
+    loc_lf = (
+        lf.filter(pl.col("location_weight").is_not_null())
+          .select([
+              "obs_id",
+              timestamp,
+              pl.col("h3_res3").cast(pl.Categorical),
+              "location_weight",
+          ])
+    )
 
-###############################################################
-# STEP 2: FEATURE BUILDER FOR ONE CELL
-###############################################################
-def build_features_for_cell(cell_df: pl.DataFrame) -> pl.DataFrame:
+    # timestamp is a property of the observation, so it rides on the location
+    # side only: the string parse runs once, and the join key is just obs_id
+    meas_lf = (
+        lf.filter(pl.col("measurement_weight").is_not_null())
+          .select([
+              "obs_id",
+              pl.col("measurement_type").cast(meas_enum),
+              "measurement_weight",
+          ])
+    )
 
-    cell_id = cell_df["h3_res3"][0]
+    atomic_lf = (
+        loc_lf.join(meas_lf, on="obs_id", how="inner")
+              .with_columns(
+                  # Float32: products of probabilities in [0, 1]; half the bytes
+                  # through the pivot and windows, and in the output
+                  (pl.col("location_weight") * pl.col("measurement_weight"))
+                      .cast(pl.Float32)
+                      .alias("signal_weight")
+              )
+    )
 
-    # Pivot wide
+    ###############################################################
+    # STEP 2: HOURLY PIVOT FOR ALL CELLS
+    ###############################################################
+    # Bucket to the hour first so the pivot only sees one row per
+    # (cell, hour, measurement_type). Passing on_columns up front lets
+    # the lazy pivot plan as a group_by instead of discovering categories.
     pivoted = (
-        cell_df.pivot(
-            index="timestamp",
-            columns="measurement_type",
-            values="signal_weight",
-            aggregate_function="sum"
-        )
-        .sort("timestamp")
+        atomic_lf
+          .with_columns(pl.col("timestamp").dt.truncate("1h"))
+          .group_by(["h3_res3", "timestamp", "measurement_type"])
+          .agg(pl.col("signal_weight").sum())
+          .pivot(
+              on="measurement_type",
+              on_columns=measurement_types,
+              index=["h3_res3", "timestamp"],
+              values="signal_weight",
+              aggregate_function="sum",
+          )
+          .cache()    # read twice below (grid bounds + the join); computed once
     )
 
-    # Hourly upsample WITHIN THIS CELL
-    pivoted = (
+    # Hourly grid per cell, from that cell's first to last hour
+    # (replaces the per-cell upsample)
+    grid = (
         pivoted
-            .set_sorted("timestamp")
-            .upsample(time_column="timestamp", every="1h")
+          .group_by("h3_res3")
+          .agg(
+              pl.datetime_range(
+                  pl.col("timestamp").min(),
+                  pl.col("timestamp").max(),
+                  interval="1h",
+              ).alias("timestamp")
+          )
+          .explode("timestamp")
+    )
+
+    pivoted = (
+        grid.join(pivoted, on=["h3_res3", "timestamp"], how="left")
             .fill_null(0.0)
+            .sort(["h3_res3", "timestamp"])
+    )
+
+    ###############################################################
+    # STEP 3: ROLLING WINDOWS FOR ALL CELLS (per cell via over)
+    #   On the uniform hourly grid, a span-hour rolling sum is
+    #   cum[i] - cum[i - span]: one cumulative sum per column, then one
+    #   shift + subtract per window, whatever the span.
+    #   Presence is cum-summed straight off the Boolean mask (UInt32, the
+    #   narrowest running count that can't overflow); casting the mask to
+    #   UInt8 first would make cum_sum widen it to Int64.
+    #   The signal running sum is Float64 even though the columns are
+    #   Float32: it grows over the whole grid, and in 7 significant digits
+    #   cum[i] - cum[i - span] would lose the window's own digits.
+    ###############################################################
+    cum = pivoted.with_columns(
+        [pl.col(mt).cast(pl.Float64).cum_sum().over("h3_res3").alias(f"_cs_{mt}") for mt in measurement_types]
+        + [(pl.col(mt) > 0).cum_sum().over("h3_res3").alias(f"_cc_{mt}") for mt in measurement_types]
     )
 
-    # Add missing measurement types
-    for mt in measurement_types:
-        if mt not in pivoted.columns:
-            pivoted = pivoted.with_columns(pl.lit(0.0).alias(mt))
+    def windowed(col, span):
+        return (pl.col(col) - pl.col(col).shift(span, fill_value=0)).over("h3_res3")
 
-    # Compute rolling windows
-    rolling = pivoted
+    rolling_exprs = []
     for label, span in WINDOWS.items():
-        rolling = rolling.with_columns([
-            pl.col(mt).rolling_sum(span).alias(f"{mt}__sum_{label}")
+        rolling_exprs += [
+            windowed(f"_cs_{mt}", span).cast(pl.Float32).alias(f"{mt}__sum_{label}")
             for mt in measurement_types
-        ])
-        rolling = rolling.with_columns([
-            (pl.col(mt) > 0).cast(pl.Int32).rolling_sum(span).alias(f"{mt}__count_{label}")
+        ]
+        rolling_exprs += [
+            windowed(f"_cc_{mt}", span).cast(pl.UInt8).alias(f"{mt}__count_{label}")
             for mt in measurement_types
-        ])
-
-    # Remove raw measurement columns
-    rolling = rolling.drop_columns(measurement_types)
-
-    # Add cell id
-    rolling = rolling.with_columns(pl.lit(cell_id).alias("h3_res3"))
-
-    return rolling
-
+        ]
 
-###############################################################
-# STEP 3: APPLY FEATURE BUILDER FOR ALL CELLS IN PARALLEL
-###############################################################
-features_df = atomic_df.groupby("h3_res3").apply(build_features_for_cell)
+    # Remove raw measurement columns and the cumulative helpers
+    rolling = (
+        cum.with_columns(rolling_exprs)
+           .drop(measurement_types)
+           .drop(pl.selectors.starts_with("_cs_", "_cc_"))
+    )
 
+    ###############################################################
+    # STEP 4: WRITE EACH CELL'S PARTITION
+    #   One partitioned sink writes every cell's file from the plan in a
+    #   single pass. The sort and the cum_sum().over("h3_res3") windows
+    #   still hold the full table in memory before it is written.
+    ###############################################################
+    rolling.sink_parquet(
+        pl.PartitionBy(
+            OUTPUT_PATH,
+            key="h3_res3",
+            include_key=True,
+            approximate_bytes_per_file=None,   # one file per cell
+            file_path_provider=lambda args: f"h3_res3={args.partition_keys['h3_res3'][0]}.parquet",
+        ),
+        compression="zstd",
+        row_group_size=100_000,
+        mkdir=True,
+    )
+    print("Wrote", OUTPUT_PATH)
 
-###############################################################
-# STEP 4: WRITE EACH CELL'S PARTITION
-###############################################################
-for cell_id, df_cell in features_df.groupby("h3_res3"):
-    out_path = f"{OUTPUT_PATH}/h3_res3={cell_id}.parquet"
-    df_cell.write_parquet(out_path)
-    print("Wrote", out_path)
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
 
+def run_loop_pipeline():
+    """
+    Per-cell pipeline: one lazy plan per cell, concatenated and written
+    to the global table and the per-cell files in a single pass.
+    """
+    ###############################################################
+    # CONFIGURATION
+    ###############################################################
 
+    PARQUET_PATH = "s3://bucket/path/**/*.parquet"
 
+    # Rolling windows in HOURS (row count = hours since we use an hourly grid)
+    WINDOWS = {
+        "1h": 1,
+        "6h": 6,
+        "12h": 12,
+        "24h": 24,
+    }
 
+    # Output locations
+    OUTPUT_PATH_GLOBAL = "s3://bucket/features/global_features.parquet"
+    OUTPUT_PATH_PER_CELL = "s3://bucket/features/cells"  # we'll do h3=<cell>/features.parquet
 
+    # Adjust these if your flattened schema uses different names:
+    LOCATION_LAT_COL = "location_lat"
+    LOCATION_LON_COL = "location_lon"
 
+    # Input columns read by this pipeline
+    INPUT_COLUMNS_LOOP = [*INPUT_COLUMNS, LOCATION_LAT_COL, LOCATION_LON_COL]
 
+    ###############################################################
+    # GLOBAL LAZY SCAN
+    #   Only the input columns are ever read from the files; timestamp
+    #   is parsed only where a step selects it
+    ###############################################################
+    lf, timestamp = scan_input(PARQUET_PATH, INPUT_COLUMNS_LOOP)
 
+    ###############################################################
+    # STEP 0: GLOBAL MEASUREMENT VOCABULARY
+    #   and STEP 1's timestamp bounds, from the same pass over the input
+    ###############################################################
+    print("Extracting global measurement vocabulary and timestamp bounds…")
 
+    ts_bounds = (
+        lf.select([
+            pl.col("measurement_type").drop_nulls().unique().implode(),
+            timestamp.min().alias("min_ts"),
+            timestamp.max().alias("max_ts"),
+        ])
+        .collect(engine="streaming")
+    )
 
+    measurement_types = ts_bounds["measurement_type"][0].to_list()
+    print(f"Found {len(measurement_types)} measurement types.")
 
+    # Join / group_by / pivot keys as integer codes rather than strings:
+    # measurement_type over its fixed global vocabulary, h3_res3 as Categorical
+    meas_enum = pl.Enum(measurement_types)
 
+    ###############################################################
+    # STEP 1: GLOBAL TIMESTAMP RANGE  (for global 1h grid)
+    ###############################################################
 
+    min_ts = ts_bounds["min_ts"][0]
+    max_ts = ts_bounds["max_ts"][0]
 
+    # Floor min_ts to the hour, ceil max_ts to the next hour
+    min_ts = min_ts.replace(minute=0, second=0, microsecond=0)
+    if max_ts.minute != 0 or max_ts.second != 0 or max_ts.microsecond != 0:
+        max_ts = (max_ts + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
 
+    print(f"Global time range: {min_ts} → {max_ts}")
 
+    # Global hourly grid DataFrame (will be reused for every cell)
+    #min_ts = datetime(2024, 2, 2, 20, 0, 0)
+    #max_ts = datetime(2025, 11, 26, 21, 0, 0)
 
+    global_hours = pl.DataFrame({
+        "timestamp": pl.datetime_range(
+            start=min_ts,
+            end=max_ts,
+            interval="1h",
+            eager=True,
+            closed="left",
+        )
+    })
 
-import polars as pl
-from datetime import timedelta, datetime
+    ###############################################################
+    # STEP 2: BUILD GLOBAL PMHT-STYLE ATOMIC TABLE
+    #   obs_id × location × meas_type → signal_weight per hour
+    ###############################################################
 
-###############################################################
-# CONFIGURATION
-###############################################################
-
-PARQUET_PATH = "s3://bucket/path/**/*.parquet"
-
-# Rolling windows in HOURS (row count = hours since we use an hourly grid)
-WINDOWS = {
-    "1h": 1,
-    "6h": 6,
-    "12h": 12,
-    "24h": 24,
-}
-
-# Output locations
-OUTPUT_PATH_GLOBAL = "s3://bucket/features/global_features.parquet"
-OUTPUT_PATH_PER_CELL = "s3://bucket/features/cells"  # we'll do h3=<cell>/features.parquet
-
-# Adjust these if your flattened schema uses different names:
-LOCATION_LAT_COL = "location_lat"
-LOCATION_LON_COL = "location_lon"
-
-
-###############################################################
-# GLOBAL LAZY SCAN
-###############################################################
-lf = pl.scan_parquet(PARQUET_PATH)
-
-###############################################################
-# STEP 0: GLOBAL MEASUREMENT VOCABULARY
-###############################################################
-print("Extracting global measurement vocabulary…")
-
-global_vocab = (
-    lf.filter(pl.col("measurement_type").is_not_null())
-      .select("measurement_type")
-      .unique()
-      .collect()
-)
-
-measurement_types = global_vocab["measurement_type"].to_list()
-print(f"Found {len(measurement_types)} measurement types.")
-
-
-###############################################################
-# STEP 1: GLOBAL TIMESTAMP RANGE  (for global 1h grid)
-###############################################################
-print("Computing global timestamp bounds…")
-
-ts_bounds = (
-    lf.select(
-        pl.col("timestamp")
-          .cast(pl.Utf8)
-          .str.to_datetime(strict=False)
-          .alias("timestamp")
-    )
-    .select([
-        pl.col("timestamp").min().alias("min_ts"),
-        pl.col("timestamp").max().alias("max_ts"),
-    ])
-    .collect()
-)
-
-min_ts = ts_bounds["min_ts"][0]
-max_ts = ts_bounds["max_ts"][0]
-
-# Floor min_ts to the hour, ceil max_ts to the next hour
-min_ts = min_ts.replace(minute=0, second=0, microsecond=0)
-if max_ts.minute != 0 or max_ts.second != 0 or max_ts.microsecond != 0:
-    max_ts = (max_ts + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-
-print(f"Global time range: {min_ts} → {max_ts}")
-
-# Global hourly grid DataFrame (will be reused for every cell)
-#min_ts = datetime(2024, 2, 2, 20, 0, 0)
-#max_ts = datetime(2025, 11, 26, 21, 0, 0)
-
-global_hours = pl.DataFrame({
-    "timestamp": pl.date_range(
-        start=min_ts,
-        end=max_ts,
-        interval="1h",
-        eager=True,
-        closed="left",
-    )
-})
-
-
-###############################################################
-# STEP 2: BUILD GLOBAL PMHT-STYLE ATOMIC TABLE
-#   obs_id × location × meas_type → signal_weight per hour
-###############################################################
-
-# Location side:
-# One row per (obs_id, h3_res3, location_weight, lat, lon, timestamp_str).
-# We include lat/lon so that .unique() removes repeated rows caused by deeper
-# nested lists but *keeps* distinct candidate locations with different lat/lon.
-lf_loc = (
-    lf.filter(pl.col("location_weight").is_not_null())
-      .select([
-          "obs_id",
-          "h3_res3",
-          "location_weight",
-          LOCATION_LAT_COL,
-          LOCATION_LON_COL,
-          pl.col("timestamp").cast(pl.Utf8).alias("timestamp_str"),
-      ])
-      .unique()
-)
-
-# Measurement side:
-# One row per (obs_id, measurement_type, measurement_weight).
-# We also .unique() here in case the flattened schema can repeat these.
-lf_meas = (
-    lf.filter(pl.col("measurement_weight").is_not_null())
-      .select([
-          "obs_id",
-          "measurement_type",
-          "measurement_weight",
-      ])
-      .unique()
-)
-
-print("Building global atomic PMHT table…")
-
-lf_atomic = (
-    lf_loc.join(lf_meas, on="obs_id", how="inner")
-          .with_columns([
-              # Parse + truncate timestamps to hour buckets
-              pl.col("timestamp_str")
-                .str.to_datetime(strict=False)
-                .dt.truncate("1h")
-                .alias("timestamp"),
-
-              # PMHT-style signal weight:
-              #   signal_weight = location_weight * measurement_weight
-              (pl.col("location_weight") * pl.col("measurement_weight"))
-                  .alias("signal_weight"),
-          ])
-          # We no longer need lat/lon or the raw weight columns here for features;
-          # they have already been used to construct signal_weight.
+    # Location side:
+    # One row per (obs_id, h3_res3, location_weight, lat, lon, timestamp).
+    # We include lat/lon so that .unique() removes repeated rows caused by deeper
+    # nested lists but *keeps* distinct candidate locations with different lat/lon.
+    lf_loc = (
+        lf.filter(pl.col("location_weight").is_not_null())
           .select([
-              "h3_res3",
-              "timestamp",
-              "measurement_type",
-              "signal_weight",
+              "obs_id",
+              pl.col("h3_res3").cast(pl.Categorical),
+              "location_weight",
+              LOCATION_LAT_COL,
+              LOCATION_LON_COL,
+              timestamp,
           ])
-          .unique()  # extra safety: drop any exact duplicate atomic rows
-)
-
-#lf_atomic.sink_parquet(
-    #output_path="atomic_pmht/",
-    #partition_by="h3_res3"
-#)
+          .unique()
+    )
 
-# Materialize atomic table once
-atomic_df = lf_atomic.collect()
-print(f"Atomic PMHT table: {atomic_df.height} rows, {atomic_df.width} columns")
+    # Measurement side:
+    # One row per (obs_id, measurement_type). The flattened schema can repeat
+    # these, always with the same weight, so dedup on that key and keep the first.
+    lf_meas = (
+        lf.filter(pl.col("measurement_weight").is_not_null())
+          .group_by(["obs_id", pl.col("measurement_type").cast(meas_enum)])
+          .agg(pl.col("measurement_weight").first())
+    )
 
+    print("Building global atomic PMHT table…")
+
+    lf_atomic = (
+        lf_loc.join(lf_meas, on="obs_id", how="inner")
+              .with_columns([
+                  # Truncate timestamps to hour buckets
+                  pl.col("timestamp").dt.truncate("1h"),
+
+                  # PMHT-style signal weight:
+                  #   signal_weight = location_weight * measurement_weight
+                  # Float32: products of probabilities in [0, 1]; half the bytes
+                  # through the pivot and windows, and in the output
+                  (pl.col("location_weight") * pl.col("measurement_weight"))
+                      .cast(pl.Float32)
+                      .alias("signal_weight"),
+              ])
+              # We no longer need lat/lon or the raw weight columns here for features;
+              # they have already been used to construct signal_weight.
+              # No unique() after this: both sides are deduplicated already, and
+              # once obs_id and lat/lon are projected away, two real contributions
+              # (other observations, or other candidates in the same cell and hour)
+              # can be identical rows that must both be summed.
+              .select([
+                  "h3_res3",
+                  "timestamp",
+                  "measurement_type",
+                  "signal_weight",
+              ])
+    )
 
-###############################################################
-# STEP 3: DEFINE PER-CELL FEATURE BUILDER
-###############################################################
+    #lf_atomic.sink_parquet(
+        #output_path="atomic_pmht/",
+        #partition_by="h3_res3"
+    #)
 
-def build_features_for_cell(df: pl.DataFrame) -> pl.DataFrame:
-    """
-    df: all atomic rows for a single h3_res3 cell
-        columns: [h3_res3, timestamp, measurement_type, signal_weight]
-    returns: hourly-grid rolling feature table for this cell
-
-    Steps:
-      1. pivot to wide per timestamp (one col per measurement_type)
-      2. align to global hourly grid
-      3. ensure all global measurement_types exist as columns
-      4. compute rolling windows (sum + count) over the hourly grid
-      5. drop raw per-type columns, keep rolling features + timestamp + h3_res3
-    """
+    # Materialize atomic table once
+    atomic_df = lf_atomic.collect(engine="streaming")
+    print(f"Atomic PMHT table: {atomic_df.height} rows, {atomic_df.width} columns")
 
-    cell_id = df["h3_res3"][0]
+    ###############################################################
+    # STEP 3: DEFINE PER-CELL FEATURE BUILDER
+    ###############################################################
 
-    # --- Pivot to wide (per-cell, per-hour, per-measurement_type sum of signal_weight) ---
-    pivoted = (
-        df.pivot(
+    def cell_plan(cell_id, df: pl.DataFrame) -> pl.LazyFrame:
+        """
+        df: all atomic rows for a single h3_res3 cell
+            columns: [h3_res3, timestamp, measurement_type, signal_weight]
+        returns: hourly-grid rolling feature table for this cell, as a lazy
+                 plan (nothing runs until it is collected)
+
+        Steps:
+          1. pivot to wide per timestamp (one col per global measurement_type)
+          2. align to global hourly grid
+          3. compute rolling windows (sum + count) over the hourly grid
+          4. drop raw per-type columns, keep rolling features + timestamp + h3_res3
+        """
+
+        # --- Pivot to wide (per-cell, per-hour, per-measurement_type sum of signal_weight) ---
+        # on_columns=measurement_types emits every global type, present in
+        # this cell or not, and is what lets the pivot stay lazy.
+        pivoted = df.lazy().pivot(
+            on="measurement_type",
+            on_columns=measurement_types,
             index="timestamp",
-            columns="measurement_type",
             values="signal_weight",
             aggregate_function="sum",
         )
-        .sort("timestamp")
-    )
-
-    # --- Align to global hourly grid (same time axis for all cells) ---
-    # Left join global_hours to pivoted; hours with no signal become 0.
-    pivoted = (
-        global_hours.join(pivoted, on="timestamp", how="left")
-                    .fill_null(0.0)
-    )
-
-    # --- Ensure full measurement vocabulary exists in columns ---
-    for mt in measurement_types:
-        if mt not in pivoted.columns:
-            pivoted = pivoted.with_columns(pl.lit(0.0).alias(mt))
-
-    # --- Rolling-window features ---
-    # At this point:
-    #   pivoted: timestamp | mt_1 | mt_2 | ... | mt_K
-    # where mt_i are all measurement_types, aligned on hourly grid.
-    rolling = pivoted.set_sorted("timestamp")
-
-    for label, span in WINDOWS.items():
-        # Sum of signal over window (span hours)
-        rolling = rolling.with_columns([
-            pl.col(mt)
-              .rolling_sum(span)
-              .alias(f"{mt}__sum_{label}")
-            for mt in measurement_types
-        ])
-
-        # Count of presence over window (nonzero)
-        rolling = rolling.with_columns([
-            (pl.col(mt) > 0)
-               .cast(pl.Int32)
-               .rolling_sum(span)
-               .alias(f"{mt}__count_{label}")
-            for mt in measurement_types
-        ])
-
-    # Drop the raw per-hour measurement-weight columns, keep timestamp for index
-    rolling = rolling.drop(measurement_types)
-
-    # Add h3_res3 column back as a constant for all rows in this cell
-    rolling = rolling.with_columns(pl.lit(cell_id).alias("h3_res3"))
-
-    # Optional: sort columns nicely (timestamp, h3_res3, then features)
-    cols = ["timestamp", "h3_res3"] + [
-        c for c in rolling.columns if c not in ("timestamp", "h3_res3")
-    ]
-    rolling = rolling.select(cols)
-
-    return rolling
-
-
-###############################################################
-# STEP 4: APPLY PER-CELL FEATURE BUILDER VIA group_by().map_groups()
-###############################################################
-print("Building per-cell feature tables inside Polars…")
-
-features_all_cells = (
-    atomic_df
-        .group_by("h3_res3", maintain_order=False)
-        .map_groups(build_features_for_cell)
-)
-
-print(f"Global features DF: {features_all_cells.height} rows, {features_all_cells.width} cols")
-
-
-###############################################################
-# STEP 5: WRITE ONE BIG GLOBAL TABLE
-###############################################################
-print(f"Writing global feature table → {OUTPUT_PATH_GLOBAL}")
-features_all_cells.write_parquet(OUTPUT_PATH_GLOBAL)
-
-
-###############################################################
-# STEP 6: WRITE ONE PARQUET PER CELL
-###############################################################
-print("Writing per-cell feature tables…")
-
-cell_groups = features_all_cells.partition_by("h3_res3", as_dict=True)
-
-for cell_id, df_cell in cell_groups.items():
-    out_path = f"{OUTPUT_PATH_PER_CELL}/h3={cell_id}/features.parquet"
-    df_cell.write_parquet(out_path)
-    # You can print or log intermittently if you want visibility:
-    # print(f"✔ Wrote {cell_id} → {out_path}")
-
-
-
-
 
+        # --- Align to global hourly grid (same time axis for all cells) ---
+        # Left join global_hours to pivoted; hours with no signal become 0.
+        pivoted = (
+            global_hours.lazy()
+                        .join(pivoted, on="timestamp", how="left", maintain_order="left")
+                        .fill_null(0.0)
+        )
 
+        # --- Rolling-window features ---
+        # At this point:
+        #   pivoted: timestamp | mt_1 | mt_2 | ... | mt_K
+        # where mt_i are all measurement_types, aligned on hourly grid.
+        # On that uniform grid a span-hour rolling sum is cum[i] - cum[i - span],
+        # so each column gets one cumulative sum (signal, and presence off the
+        # Boolean mask), and every window is a shift + subtract of it.
+        # The Boolean cum_sum is UInt32; a UInt8 mask would be widened to Int64.
+        # The signal running sum is Float64 even though the columns are Float32:
+        # it grows over the whole grid, and at 7 significant digits the
+        # subtraction would lose the window's own digits.
+        cum = pivoted.with_columns(
+            [pl.col(mt).cast(pl.Float64).cum_sum().alias(f"_cs_{mt}") for mt in measurement_types]
+            + [(pl.col(mt) > 0).cum_sum().alias(f"_cc_{mt}") for mt in measurement_types]
+        )
 
+        rolling_exprs = []
+
+        for label, span in WINDOWS.items():
+            # Sum of signal over window (span hours)
+            rolling_exprs += [
+                (pl.col(f"_cs_{mt}") - pl.col(f"_cs_{mt}").shift(span, fill_value=0))
+                  .cast(pl.Float32)
+                  .alias(f"{mt}__sum_{label}")
+                for mt in measurement_types
+            ]
+
+            # Count of presence over window (nonzero); max count is the span, fits UInt8
+            rolling_exprs += [
+                (pl.col(f"_cc_{mt}") - pl.col(f"_cc_{mt}").shift(span, fill_value=0))
+                   .cast(pl.UInt8)
+                   .alias(f"{mt}__count_{label}")
+                for mt in measurement_types
+            ]
+
+        rolling = (
+            cum.with_columns(rolling_exprs)
+               .drop(pl.selectors.starts_with("_cs_", "_cc_"))
+        )
 
+        # Drop the raw per-hour measurement-weight columns, keep timestamp for index
+        rolling = rolling.drop(measurement_types)
 
+        # Add h3_res3 column back as a constant for all rows in this cell
+        rolling = rolling.with_columns(pl.lit(cell_id).alias("h3_res3"))
 
+        # Optional: sort columns nicely (timestamp, h3_res3, then features)
+        cols = ["timestamp", "h3_res3"] + [
+            c for c in rolling.collect_schema().names() if c not in ("timestamp", "h3_res3")
+        ]
+        rolling = rolling.select(cols)
 
+        return rolling
 
-from concurrent.futures import ThreadPoolExecutor
+    ###############################################################
+    # STEP 4: COMBINE ALL PER-CELL PLANS
+    #   One lazy plan per cell, unioned into a single lazy feature table:
+    #   the engine runs the cells in parallel on its thread pool instead
+    #   of one Python callback at a time, and nothing is collected here.
+    ###############################################################
+    print("Building per-cell feature plans…")
 
-with ThreadPoolExecutor(max_workers=16) as pool:
-    pool.map(process_cell, all_cells)
-    
-    
-    
-    
-    
-    
-def build_labels_for_cell(events_df, global_hours, cell_id, windows):
-    """
-    events_df: dataframe of *all* events for the entire dataset,
-               with columns ["h3_res3", "timestamp", "label"]
-    global_hours: global hourly index
-    cell_id: the h3 cell we are labeling
-    windows: dict like {"1h": 1, "6h": 6, ...}
-    """
+    plans = [
+        cell_plan(cell_id, df_cell)
+        for (cell_id,), df_cell in atomic_df.partition_by("h3_res3", as_dict=True).items()
+    ]
 
-    # 1) Filter just this cell's events
-    ev = events_df.filter(pl.col("h3_res3") == cell_id)
+    features_all_cells = pl.concat(plans)
 
-    # 2) Join onto the global hourly grid to create a dense 0/1 series
-    labels = (
-        global_hours.join(
-            ev.select(["timestamp", "label"]),
-            on="timestamp",
-            how="left"
-        )
-        .with_columns(pl.col("label").fill_null(0))   # fill missing hours with 0
+    ###############################################################
+    # STEP 5: WRITE ONE BIG GLOBAL TABLE
+    ###############################################################
+    global_sink = features_all_cells.sink_parquet(
+        OUTPUT_PATH_GLOBAL,
+        compression="zstd",
+        row_group_size=100_000,
+        lazy=True,
     )
 
-    # ================================================================
-    # 3) COARSE LABELS (regular forward-looking horizons)
-    # ================================================================
-    rev = labels.reverse()
-
-    for name, span in windows.items():
-        rev = rev.with_columns(
-            pl.col("label")
-              .rolling_max(span)
-              .alias(f"label_{name}")   # e.g. label_6h
-        )
-
-    coarse_labels = rev.reverse()
-
-    # ================================================================
-    # 4) CONSERVATIVE LABELS (no leakage from event hour)
-    # ================================================================
-    # We need to "shift" the event indicator forward by 1 hour
-    # so that the hour containing the event is NOT marked as positive.
-    shifted = labels.with_columns(
-        pl.col("label").shift(-1).fill_null(0).alias("label_shifted")
+    ###############################################################
+    # STEP 6: WRITE ONE PARQUET PER CELL
+    #   One partitioned sink instead of a Python loop of write_parquet
+    #   calls: Polars splits the table and writes/uploads the per-cell
+    #   files concurrently.
+    ###############################################################
+    per_cell_sink = features_all_cells.sink_parquet(
+        pl.PartitionBy(
+            OUTPUT_PATH_PER_CELL,
+            key="h3_res3",
+            include_key=True,
+            approximate_bytes_per_file=None,   # exactly one file per cell
+            file_path_provider=lambda args: (
+                f"h3={args.partition_keys['h3_res3'][0]}/features.parquet"
+            ),
+        ),
+        compression="zstd",
+        row_group_size=100_000,
+        statistics=True,    # row-group min/max for predicate pushdown on read
+        mkdir=True,
+        lazy=True,
     )
 
-    rev_cons = shifted.reverse()
-
-    for name, span in windows.items():
-        rev_cons = rev_cons.with_columns(
-            pl.col("label_shifted")
-              .rolling_max(span)
-              .alias(f"label_{name}_cons")   # e.g. label_6h_cons
-        )
+    ###############################################################
+    # STEP 7: RUN BOTH SINKS
+    #   One execution for both outputs: the shared feature plan is computed
+    #   once (it becomes a cached subplan feeding both sinks), which saves
+    #   a second pass over the data. It does not bound memory: atomic_df is
+    #   collected eagerly and the per-cell plans run over in-memory frames.
+    ###############################################################
+    print(f"Writing global feature table → {OUTPUT_PATH_GLOBAL}")
+    print(f"Writing per-cell feature tables → {OUTPUT_PATH_PER_CELL}")
+    pl.collect_all([global_sink, per_cell_sink], engine="streaming")
 
-    conservative_labels = rev_cons.reverse()
-
-    # ================================================================
-    # 5) Merge both sets into final label table
-    # ================================================================
-    final = labels.join(
-        coarse_labels.drop("label"),
-        on="timestamp",
-        how="inner"
-    ).join(
-        conservative_labels.drop(["label", "label_shifted"]),
-        on="timestamp",
-        how="inner"
-    )
 
-    # You now have:
-    # timestamp | label | label_1h | ... | label_24h | label_1h_cons | ... | label_24h_cons
-
-    return final
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    def build_hourly_event_series(events_df, global_hours, cell_id):
+def build_hourly_event_series(events_df, global_hours, cell_id):
     """
     Returns:
       timestamp | event
@@ -793,9 +881,8 @@ def build_labels_for_cell(events_df, global_hours, cell_id, windows):
     )
 
     return hourly
-    
-    
-    
+
+
 def add_future_labels(hourly, windows):
     """
     Adds:
@@ -814,12 +901,8 @@ def add_future_labels(hourly, windows):
         )
 
     return rev.reverse()
-    
-    
-    
-    
-    
-    
+
+
 def add_inclusive_labels(hourly, windows):
     """
     Adds:
@@ -836,41 +919,22 @@ def add_inclusive_labels(hourly, windows):
         )
 
     return rev.reverse()
-    
-    
+
+
 def build_labels_for_cell(events_df, global_hours, cell_id, windows):
+    """
+    Returns:
+      timestamp | event
+      | label_future_1h | ... | label_future_24h
+      | label_inclusive_1h | ... | label_inclusive_24h
+    """
     hourly = build_hourly_event_series(events_df, global_hours, cell_id)
 
     hourly = add_future_labels(hourly, windows)
     hourly = add_inclusive_labels(hourly, windows)
 
     return hourly
-    
-    
-timestamp
-event
-label_future_1h
-label_future_6h
-label_future_12h
-label_future_24h
-label_inclusive_1h
-label_inclusive_6h
-label_inclusive_12h
-label_inclusive_24h
-    
-    
-agg = (
-    df.group_by(["timestamp", "measurement_type"])
-      .agg([
-          pl.col("signal_weight").sum().alias("sum_w"),
-          pl.len().alias("cnt_w"),
-      ])
-)
-
-wide = agg.pivot(
-    index="timestamp",
-    columns="measurement_type",
-    values=["sum_w", "cnt_w"],
-    aggregate_function="sum",
-)
-    
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    run_global_pipeline()
@@ -1,18 +1,41 @@
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import polars as pl
 
-TRUTH = None  # global per process
+# Cell reads wait on S3, and both boto3 and Polars release the GIL while
+# they do, so threads overlap the requests without any pickling between them.
+MAX_WORKERS = 32
 
+TRUTH = None  # loaded once, shared by all threads
+S3 = None     # boto3 clients are thread-safe; one pooled client for all threads
 
-def init_worker(truth_path):
-    global TRUTH
+
+def init_shared(truth_path):
+    global TRUTH, S3
+    import boto3
+    from botocore.config import Config
+
+    S3 = boto3.client("s3", config=Config(max_pool_connections=MAX_WORKERS))
     TRUTH = pl.read_parquet(truth_path)
 
 
-def process_cell(cell_path):
-    global TRUTH
+def read_cell(cell_path):
+    """
+    Cell files are small: fetch the whole S3 object with one GET and parse it
+    from memory, instead of one ranged GET per row group. Local paths are
+    read directly.
+    """
+    if not cell_path.startswith("s3://"):
+        return pl.read_parquet(cell_path)
 
-    df = pl.read_parquet(cell_path)
+    # Split by hand: urlparse would cut keys containing "?" or "#"
+    bucket, _, key = cell_path[len("s3://"):].partition("/")
+    body = S3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    return pl.read_parquet(BytesIO(body))
+
+
+def process_cell(cell_path):
+    df = read_cell(cell_path)
 
 
     return cell_path
@@ -22,9 +45,7 @@ if __name__ == "__main__":
     cell_paths = [...]                  # list of parquet paths (strings)
     truth_path = "s3://bucket/truth.parquet"
 
-    with ProcessPoolExecutor(
-        max_workers=4,
-        initializer=init_worker,
-        initargs=(truth_path,),
-    ) as pool:
-        list(pool.map(process_cell, cell_paths))
\ No newline at end of file
+    init_shared(truth_path)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        list(pool.map(process_cell, cell_paths))
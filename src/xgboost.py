@@ -1,4 +1,10 @@
 import datetime as dt
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from operator import itemgetter
 import polars as pl
 import xgboost as xgb
 import os
@@ -17,6 +23,25 @@ os.environ["FSSPEC_S3_CACHE_MAXSIZE"] = "15TB"  # or however large you want
 FEATURE_PREFIX = "s3://bucket/feature_store"
 LABEL_COL = "label_exclusive_6h"
 
+# Cells loaded ahead of the one XGBoost is consuming. Each in-flight cell
+# holds one batch in memory.
+PREFETCH_CELLS = 4
+
+# Local copies of each cell's sliced float32 batch (Arrow IPC). Warm runs read
+# these instead of S3. XGBoost can't serialize a QuantileDMatrix, so the
+# quantile sketch itself is still rebuilt each run.
+BATCH_CACHE_DIR = "/mnt/data/batch_cache"
+
+# ExtMemQuantileDMatrix pages, one prefix per split. Each page is written to
+# disk as soon as it is sketched, so the raw batches don't stay in RAM while
+# the whole matrix is built.
+XGB_CACHE_DIR = "/mnt/data/xgb_cache"
+
+# "cuda" trains on the GPU histogram method (hist + device). Batches stay
+# NumPy; XGBoost copies each one to the device once while it builds the
+# matrix, not on every boosting round.
+DEVICE = "cpu"
+
 CELLS_TO_TRAIN = [
     "831c6ffffffffff",
     "831c2fffffffffff",
@@ -38,10 +63,37 @@ TEST_END    = dt.datetime(2024, 7, 1)
 # HELPERS
 #############################################
 
-def load_parquet_from_s3(cell_id: str) -> pl.DataFrame:
-    uri = f"{FEATURE_PREFIX}/h3={cell_id}/features.parquet"
-    print(f"📥 Loading parquet: {uri}")
-    return pl.read_parquet(uri)
+def cell_uri(cell_id: str) -> str:
+    return f"{FEATURE_PREFIX}/h3={cell_id}/features.parquet"
+
+def scan_parquet_from_s3(cell_id: str) -> pl.LazyFrame:
+    # Lazy, so the time filter and column selection are pushed into the
+    # reader: only the needed columns, and only row groups whose timestamp
+    # statistics overlap the window, are fetched from S3.
+    uri = cell_uri(cell_id)
+    print(f"📥 Scanning parquet: {uri}")
+    return pl.scan_parquet(uri, hive_partitioning=False)
+
+def batch_cache_path(cell_id, start, end, columns):
+    """
+    Cache file for one cell's batch. The key covers the source object's
+    version (ETag or mtime, and size), the window and the column list, so a
+    rebuilt feature store or a changed feature set never hits a stale entry.
+    None when fsspec isn't installed (caching is then skipped).
+    """
+    try:
+        import fsspec
+    except ImportError:
+        return None
+
+    uri = cell_uri(cell_id)
+    fs, path = fsspec.core.url_to_fs(uri)
+    info = fs.info(path)
+    version = f"{info.get('ETag') or info.get('mtime')}:{info.get('size')}"
+    key = hashlib.blake2b(
+        repr((uri, version, start, end, columns)).encode(), digest_size=16
+    ).hexdigest()
+    return os.path.join(BATCH_CACHE_DIR, f"{key}.arrow")
 
 def time_slice(df, start, end):
     return df.filter(
@@ -49,11 +101,43 @@ def time_slice(df, start, end):
         (pl.col("timestamp") < end)
     )
 
-def select_training_columns(df):
-    lbl = LABEL_COL
-    sums = [c for c in df.columns if "__sum_" in c]
-    cnts = [c for c in df.columns if "__count_" in c]
-    return df.select([lbl, *sums, *cnts])
+def training_columns(cell_id):
+    # Label first, then features in sorted order, from one cell's schema
+    # (only the footer is read). Every batch of a matrix is selected with the
+    # same list, so the columns line up (a cell missing one fails instead of
+    # shifting X).
+    names = scan_parquet_from_s3(cell_id).collect_schema().names()
+    sums = [c for c in names if "__sum_" in c]
+    cnts = [c for c in names if "__count_" in c]
+    return [LABEL_COL, *sorted([*sums, *cnts])]
+
+def load_batch(cell_id, start, end, columns, cache_path=None):
+    """
+    (X, y) for one cell's rows in [start, end), or None if it has none.
+    Read from / written to cache_path unless it is None.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        df = pl.read_ipc(cache_path)
+    else:
+        # Cast inside the scan, so the collected frame is already the float32
+        # batch and the 2D matrix XGBoost needs is the only copy after it.
+        # The counts are UInt8 and exact in float32, and the sums are already
+        # Float32, which is the precision XGBoost sketches in.
+        lf = time_slice(scan_parquet_from_s3(cell_id), start, end).select(columns)
+        df = lf.cast(pl.Float32).collect(engine="streaming")
+        if cache_path is not None:
+            # Written under a temporary name and renamed, so an interrupted
+            # run never leaves a truncated entry behind
+            os.makedirs(BATCH_CACHE_DIR, exist_ok=True)
+            df.write_ipc(f"{cache_path}.tmp")
+            os.replace(f"{cache_path}.tmp", cache_path)
+
+    if df.is_empty():
+        return None
+
+    y = df[LABEL_COL].to_numpy()
+    X = df.drop(LABEL_COL).to_numpy()
+    return X, y
 
 
 #############################################
@@ -61,11 +145,15 @@ def select_training_columns(df):
 #############################################
 
 class ParquetIter(xgb.core.DataIter):
-    def __init__(self, cell_ids, start, end):
-        super().__init__()
+    def __init__(self, cell_ids, start, end, cache_prefix=None):
+        super().__init__(cache_prefix=cache_prefix)
         self.cell_ids = cell_ids
         self.start = start
         self.end = end
+        # Resolved here, before any prefetch thread starts, and passed to
+        # every load so all batches share one column list
+        self.columns = training_columns(cell_ids[0])
+        self._cache_paths = {}  # cell_id -> batch cache path, for every pass
         self._set_initial_state()
 
     def _set_initial_state(self):
@@ -75,44 +163,77 @@ class ParquetIter(xgb.core.DataIter):
 
     def reset(self):
         # Called by XGBoost before EVERY pass
+        self._gen.close()   # drops the previous pass's pending prefetches
         self._set_initial_state()
 
-    def _make_generator(self):
-        for cell_id in self.cell_ids:
-            df = load_parquet_from_s3(cell_id)
-            df = time_slice(df, self.start, self.end)
-
-            if df.is_empty():
-                continue
-
-            df = select_training_columns(df)
+    def _load(self, cell_id):
+        # The source object's version (one S3 HEAD) is looked up on the first
+        # pass only; XGBoost's later passes reuse the cache path
+        if cell_id not in self._cache_paths:
+            self._cache_paths[cell_id] = batch_cache_path(
+                cell_id, self.start, self.end, self.columns
+            )
+        return load_batch(
+            cell_id, self.start, self.end, self.columns, self._cache_paths[cell_id]
+        )
 
-            # --- Sort features ---
-            feature_cols = sorted([c for c in df.columns if c != LABEL_COL])
-            df = df.select([LABEL_COL, *feature_cols])
+    def _make_generator(self):
+        # Up to PREFETCH_CELLS cells are fetched and decoded on worker threads
+        # (S3 reads and Polars release the GIL) while XGBoost sketches the
+        # current batch. Batches are still yielded in cell_ids order.
+        cells = iter(self.cell_ids)
+        pool = ThreadPoolExecutor(max_workers=PREFETCH_CELLS)
+        pending = deque(
+            (cell_id, pool.submit(self._load, cell_id))
+            for cell_id in islice(cells, PREFETCH_CELLS)
+        )
+        try:
+            while pending:
+                cell_id, future = pending.popleft()
+                for nxt in islice(cells, 1):
+                    pending.append((nxt, pool.submit(self._load, nxt)))
 
-            y = df[LABEL_COL].to_numpy("float32")
-            X = df.drop(LABEL_COL).to_numpy("float32")
+                batch = future.result()
+                if batch is None:
+                    continue
 
-            print(f"Yielding batch: {cell_id}: {X.shape}")
-            yield X, y
+                X, y = batch
+                print(f"Yielding batch: {cell_id}: {X.shape}")
+                yield X, y
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
     def next(self, input_data):
-        try:
-            X, y = next(self._gen)
-            self._seen_batch = True
-            input_data(data=X, label=y)
-            return 0     # batch OK
-        except StopIteration:
+        batch = next(self._gen, None)
+        if batch is None:
             if not self._seen_batch:
                 # XGBoost will error unless we raise here
                 raise RuntimeError("Iterator yielded no batches!")
             return 1     # signal end of this epoch
 
-
-def build_quantile_dmatrix(cell_ids, start, end):
-    return xgb.QuantileDMatrix(
-        ParquetIter(cell_ids, start, end)
+        X, y = batch
+        self._seen_batch = True
+        input_data(data=X, label=y)
+        return 0     # batch OK
+
+
+def build_quantile_dmatrix(cell_ids, start, end, split, ref=None, max_bin=256,
+                           external_memory=True):
+    """
+    external_memory=True builds an ExtMemQuantileDMatrix whose pages are read
+    back from XGB_CACHE_DIR through one stateful page cursor, so only one
+    booster may train on it at a time. external_memory=False builds an
+    in-memory QuantileDMatrix, which several boosters can share (as
+    experiments.run_sweep does).
+    """
+    if not external_memory:
+        return xgb.QuantileDMatrix(ParquetIter(cell_ids, start, end), ref=ref, max_bin=max_bin)
+
+    os.makedirs(XGB_CACHE_DIR, exist_ok=True)
+    return xgb.ExtMemQuantileDMatrix(
+        ParquetIter(cell_ids, start, end, cache_prefix=os.path.join(XGB_CACHE_DIR, split)),
+        ref=ref,
+        max_bin=max_bin,
     )
 
 
@@ -120,21 +241,20 @@ def build_quantile_dmatrix(cell_ids, start, end):
 # DATASET BUILDER
 #############################################
 
-def build_datasets():
-    print("Building TRAIN dataset (QuantileDMatrix)")
-    dtrain = build_quantile_dmatrix(CELLS_TO_TRAIN, TRAIN_START, TRAIN_END)
+def build_datasets(max_bin=256, external_memory=True):
+    # External memory by default: one training run at a time. A sweep that
+    # fits several boosters concurrently needs external_memory=False.
+    kind = "ExtMemQuantileDMatrix" if external_memory else "QuantileDMatrix"
+    build = partial(build_quantile_dmatrix, max_bin=max_bin, external_memory=external_memory)
 
-    print("Building VAL dataset (QuantileDMatrix)")
-    dval = xgb.QuantileDMatrix(
-        ParquetIter(CELLS_TO_TRAIN, VAL_START, VAL_END),
-        ref=dtrain
-    )
+    print(f"Building TRAIN dataset ({kind})")
+    dtrain = build(CELLS_TO_TRAIN, TRAIN_START, TRAIN_END, "train")
 
-    print("Building TEST dataset (QuantileDMatrix)")
-    dtest = xgb.QuantileDMatrix(
-        ParquetIter(CELLS_TO_TRAIN, TEST_START, TEST_END),
-        ref=dtrain
-    )
+    print(f"Building VAL dataset ({kind})")
+    dval = build(CELLS_TO_TRAIN, VAL_START, VAL_END, "val", ref=dtrain)
+
+    print(f"Building TEST dataset ({kind})")
+    dtest = build(CELLS_TO_TRAIN, TEST_START, TEST_END, "test", ref=dtrain)
 
     return dtrain, dval, dtest
 
@@ -155,10 +275,11 @@ def train_xgboost():
         "eval_metric": "aucpr",
 
         "tree_method": "hist",   # required for QuantileDMatrix
+        "device": DEVICE,
         "max_bin": 256,
     }
 
-    print("Training XGBoost (QuantileDMatrix)...")
+    print("Training XGBoost (ExtMemQuantileDMatrix)...")
     bst = xgb.train(
         params=params,
         dtrain=dtrain,
@@ -177,13 +298,14 @@ def train_xgboost():
 #############################################
 
 def evaluate(bst, dtest, top_n=25):
-    from sklearn.metrics import average_precision_score, roc_auc_score
+    # Both metrics from one sort of the predictions (same values as sklearn's
+    # average_precision_score / roc_auc_score, which sort once each)
+    from evaluate import ranking_metrics
 
     preds = bst.predict(dtest)
     labels = dtest.get_label()
 
-    prauc = average_precision_score(labels, preds)
-    rocauc = roc_auc_score(labels, preds)
+    prauc, rocauc = ranking_metrics(labels, preds)
     event_rate = labels.mean()
 
     print("\n=============================")
@@ -201,8 +323,8 @@ def evaluate(bst, dtest, top_n=25):
 
     ranked = sorted(
         bst.get_score(importance_type="gain").items(),
-        key=lambda x: x[1],
-        reverse=True
+        key=itemgetter(1),
+        reverse=True,
     )
 
     for feat, score in ranked[:top_n]: